@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+"""
+Export a static deployment bundle for a tour.
+
+Reads a tour's waypoint JSON and the `properties` of every HiPS it uses, then
+copies only the tiles that the tour can actually request - the waypoint views,
+the zoom-out/pan/zoom-in transitions between them, a configurable margin, and
+lower-order fallback tiles - into a deploy directory.
+
+Each exported HiPS is placed in a content-hashed directory
+(hips/<hash>/<name>_hips/), and plain .jpg layers in images/<hash>/, so
+their contents never change under a given URL and can be served with a long
+max-age.
+
+The bundle has two parts, because tour-common.js resolves layer URLs against
+rootUrl while the waypoint JSON is fetched relative to the tour page:
+
+    deploy_dir/data/  -> upload to the rootUrl location (e.g. avm_images/);
+                         hashed HiPS and images, _headers and .htaccess
+    deploy_dir/tour/  -> put next to the tour HTML; the rewritten waypoint
+                         JSON pointing at the hashed URLs, and a _headers file
+
+Usage: python export_tour_bundle.py waypoints_w51.json deploy_w51 [--root ../avm_images]
+"""
+import os
+import json
+import math
+import shutil
+import hashlib
+import argparse
+
+import astropy.units as u
+from astropy.coordinates import SkyCoord, ICRS, Galactic
+from astropy_healpix import HEALPix
+
+# Angular size (deg) of one order-0 HEALPix tile edge: sqrt(4 pi / 12) rad
+TILE_SIZE_ORDER0_DEG = math.degrees(math.sqrt(4 * math.pi / 12))
+
+# Subdirectories of the deploy directory; see the module docstring
+DATA_SUBDIR = "data"
+TOUR_SUBDIR = "tour"
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+SHORT_CACHE_CONTROL = "public, max-age=300, must-revalidate"
+
+def read_properties(hips_dir):
+    """
+    Read a HiPS properties file into a dict.
+    Handles both 'key=value' and 'key    = value' styles.
+    """
+    properties = {}
+    with open(os.path.join(hips_dir, "properties")) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            properties[key.strip()] = value.strip()
+    return properties
+
+def tile_extensions(properties):
+    """File extensions for the tile formats listed in hips_tile_format"""
+    formats = properties.get('hips_tile_format', 'jpg').split()
+    return ['jpg' if fmt == 'jpeg' else fmt for fmt in formats]
+
+def hips_frame(properties):
+    """Astropy frame matching hips_frame"""
+    frame = properties.get('hips_frame', 'equatorial')
+    if frame == 'galactic':
+        return Galactic()
+    return ICRS()
+
+def order_for_fov(fov, hips_order, tile_width=512, viewport_width=1920):
+    """
+    HiPS order Aladin Lite needs to display a view of width fov (deg) without
+    upsampling: the smallest order whose tile pixels are no larger than screen
+    pixels, clamped to the orders available in the HiPS.
+    """
+    needed = math.log2(TILE_SIZE_ORDER0_DEG * viewport_width / (tile_width * fov))
+    return int(min(max(math.ceil(needed), 0), hips_order))
+
+def fov_for_order(order, tile_width=512, viewport_width=1920):
+    """Largest fov (deg) for which order_for_fov() still selects order"""
+    return TILE_SIZE_ORDER0_DEG * viewport_width / (tile_width * 2 ** (order - 1))
+
+def view_radius(fov, aspect=16 / 9, margin=0.25):
+    """Radius (deg) of the cone enclosing a view of width fov, plus a margin"""
+    half_diagonal = fov / 2 * math.sqrt(1 + 1 / aspect ** 2)
+    return half_diagonal * (1 + margin)
+
+def tiles_for_view(coord, fov, order, frame, aspect=16 / 9, margin=0.25):
+    """HEALPix (nested) indices at order that overlap a view centered on coord"""
+    healpix = HEALPix(nside=2 ** order, order='nested', frame=frame)
+    radius = view_radius(fov, aspect=aspect, margin=margin) * u.deg
+    return healpix.cone_search_skycoord(coord, radius)
+
+def path_between(start, end, fov):
+    """
+    Points along the great circle from start to end, spaced by a quarter of
+    fov, so the union of views at those points covers the whole pan.
+    """
+    separation = start.separation(end).deg
+    nsteps = max(int(math.ceil(separation / (fov / 4))), 1)
+    position_angle = start.position_angle(end)
+    return [start.directional_offset_by(position_angle, separation * step / nsteps * u.deg)
+            for step in range(nsteps + 1)]
+
+def waypoint_urls(waypoint):
+    """All layer URLs (HiPS directories or plain .jpg images) a waypoint can display"""
+    urls = []
+    for key in ('url', 'fade_layer'):
+        if waypoint.get(key):
+            urls.append(waypoint[key])
+    slider = waypoint.get('wavelength_slider')
+    if slider and slider.get('enabled', True):
+        urls.extend(entry['url'] for entry in slider.get('wavelengths', []) if entry.get('url'))
+    return urls
+
+def is_local_url(url):
+    """CDS identifiers and absolute URLs are not ours to export"""
+    return not (url.startswith('CDS/') or url.startswith('http://') or url.startswith('https://'))
+
+def is_plain_image(url):
+    """Layers tour-common.js shows with displayJPG() rather than as a HiPS"""
+    return url.endswith('.jpg')
+
+def collect_views(waypoints):
+    """
+    Build the list of (url, coord, min_fov, max_fov) views the tour can show.
+
+    Mirrors the animation in tour-common.js: zoom out to transition_fov at the
+    previous position, pan to the next waypoint, then zoom in to its fov.  The
+    layers visible during a transition are the previous and next waypoint's
+    layers plus any sticky layers.  Zoom phases are represented by their two
+    end fovs here; intermediate orders are filled in by collect_tiles().
+    """
+    views = []
+    sticky = []
+    previous = None
+    for waypoint in waypoints:
+        coord = SkyCoord(waypoint['ra'] * u.deg, waypoint['dec'] * u.deg, frame='icrs')
+        fov = waypoint['fov']
+        urls = waypoint_urls(waypoint)
+
+        if previous is not None:
+            transition_fov = max(waypoint.get('transition_fov', fov), fov, previous['fov'])
+            visible = set(previous['urls'] + urls + sticky)
+            for url in visible:
+                # Zoom out at the previous position, pan, zoom in at this one
+                views.append((url, previous['coord'], previous['fov'], transition_fov))
+                for point in path_between(previous['coord'], coord, transition_fov):
+                    views.append((url, point, transition_fov, transition_fov))
+                views.append((url, coord, fov, transition_fov))
+
+        for url in set(urls + sticky):
+            views.append((url, coord, fov, fov))
+
+        if waypoint.get('is_sticky') and waypoint.get('url'):
+            sticky.append(waypoint['url'])
+        previous = {'coord': coord, 'fov': fov, 'urls': urls}
+
+    return [view for view in views if is_local_url(view[0])]
+
+def collect_tiles(views, properties, fallback_orders=3, aspect=16 / 9, margin=0.25,
+                  viewport_width=1920):
+    """
+    Find the (order, npix) tiles needed for the views of one HiPS.
+
+    Each view is (coord, min_fov, max_fov): a zoom between two fovs at a fixed
+    position.  Every order Aladin passes through during the zoom is included,
+    each at the widest fov it is used for, along with fallback_orders lower
+    orders that Aladin shows while the sharper tiles load.
+    """
+    hips_order = int(properties.get('hips_order', 3))
+    tile_width = int(properties.get('hips_tile_width', 512))
+    frame = hips_frame(properties)
+
+    tiles = set()
+    for coord, min_fov, max_fov in views:
+        low_order = order_for_fov(max_fov, hips_order, tile_width, viewport_width)
+        high_order = order_for_fov(min_fov, hips_order, tile_width, viewport_width)
+        for view_order in range(low_order, high_order + 1):
+            fov = min(max(fov_for_order(view_order, tile_width, viewport_width), min_fov), max_fov)
+            for order in range(max(view_order - fallback_orders, 0), view_order + 1):
+                for npix in tiles_for_view(coord, fov, order, frame, aspect=aspect, margin=margin):
+                    tiles.add((order, int(npix)))
+    return tiles
+
+def tile_relpath(hips_dir, order, npix, extensions):
+    """
+    Relative path of an existing tile file, or None.
+    Checks the HiPS-standard Dir{10000*k} layout and the Dir{k} layout
+    written by fits_to_hips.py.
+    """
+    for dir_idx in (npix // 10000 * 10000, npix // 10000):
+        for ext in extensions:
+            relpath = os.path.join(f"Norder{order}", f"Dir{dir_idx}", f"Npix{npix}.{ext}")
+            if os.path.exists(os.path.join(hips_dir, relpath)):
+                return relpath
+    return None
+
+def hips_metadata_files(hips_dir):
+    """Non-tile files every export needs: properties and Allsky images"""
+    relpaths = ['properties']
+    for name in sorted(os.listdir(hips_dir)):
+        if name.startswith('Norder') and os.path.isdir(os.path.join(hips_dir, name)):
+            for allsky in sorted(os.listdir(os.path.join(hips_dir, name))):
+                if allsky.startswith('Allsky.'):
+                    relpaths.append(os.path.join(name, allsky))
+    return relpaths
+
+def content_hash(hips_dir, relpaths, length=10):
+    """Hash of the exported files' paths and contents"""
+    digest = hashlib.sha256()
+    for relpath in sorted(relpaths):
+        digest.update(relpath.encode())
+        with open(os.path.join(hips_dir, relpath), 'rb') as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()[:length]
+
+def directory_size(path):
+    """Total size in bytes of all files under path"""
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return total
+
+def write_cache_headers(data_dir, tour_dir, hashed_dirs):
+    """
+    Write cache-header hints: _headers files (Netlify / Cloudflare Pages
+    style) for the data and tour parts and an .htaccess (Apache mod_headers)
+    in each hashed directory.  The _headers paths assume each part is served
+    from its site root.  GitHub Pages ignores both and uses its own 10-minute
+    max-age.
+    """
+    lines = []
+    for hashed_dir in hashed_dirs:
+        lines.append(f"/{hashed_dir}/*")
+        lines.append(f"  Cache-Control: {IMMUTABLE_CACHE_CONTROL}")
+        with open(os.path.join(data_dir, hashed_dir, ".htaccess"), 'w') as f:
+            f.write("<IfModule mod_headers.c>\n")
+            f.write(f'  Header set Cache-Control "{IMMUTABLE_CACHE_CONTROL}"\n')
+            f.write("</IfModule>\n")
+    with open(os.path.join(data_dir, "_headers"), 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+    with open(os.path.join(tour_dir, "_headers"), 'w') as f:
+        f.write(f"/*.json\n  Cache-Control: {SHORT_CACHE_CONTROL}\n")
+
+def export_plain_image(url, root, data_dir):
+    """
+    Copy a plain .jpg layer into data_dir/images/<hash>/ and return its
+    hashed directory.
+    """
+    source = os.path.normpath(os.path.join(root, url))
+    if not os.path.isfile(source):
+        raise FileNotFoundError(f"Image {url} not found at {source}")
+    with open(source, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:10]
+    hashed_dir = os.path.join("images", digest)
+    os.makedirs(os.path.join(data_dir, hashed_dir), exist_ok=True)
+    shutil.copy2(source, os.path.join(data_dir, hashed_dir, os.path.basename(source)))
+    return hashed_dir
+
+def export_tour_bundle(waypoints_file, deploy_dir, root='.', fallback_orders=3, margin=0.25,
+                       aspect=16 / 9, viewport_width=1920):
+    """
+    Export the tiles reachable from a tour into deploy_dir/data, and the
+    rewritten waypoint JSON into deploy_dir/tour.
+    Returns a dict mapping each exported URL to its hashed URL.
+    """
+    with open(waypoints_file) as f:
+        tour = json.load(f)
+    waypoints = tour['waypoints']
+
+    views_by_url = {}
+    for url, coord, min_fov, max_fov in collect_views(waypoints):
+        views_by_url.setdefault(url, []).append((coord, min_fov, max_fov))
+    first_views = {}
+    for url, coord, min_fov, max_fov in collect_views(waypoints[:1]):
+        first_views.setdefault(url, []).append((coord, min_fov, max_fov))
+
+    data_dir = os.path.join(deploy_dir, DATA_SUBDIR)
+    tour_dir = os.path.join(deploy_dir, TOUR_SUBDIR)
+    os.makedirs(data_dir, exist_ok=True)
+    os.makedirs(tour_dir, exist_ok=True)
+    url_map = {}
+    hashed_dirs = []
+    total_source = 0
+    total_exported = 0
+    total_first_visit = 0
+
+    for url, views in sorted(views_by_url.items()):
+        if is_plain_image(url):
+            hashed_dir = export_plain_image(url, root, data_dir)
+            image_path = os.path.join(hashed_dir, os.path.basename(url))
+            image_bytes = os.path.getsize(os.path.join(data_dir, image_path))
+            total_source += image_bytes
+            total_exported += image_bytes
+            if url in first_views:
+                total_first_visit += image_bytes
+            print(f"{url}: image, {image_bytes / 1024**2:.1f} MB -> {image_path}")
+            url_map[url] = image_path
+            hashed_dirs.append(hashed_dir)
+            continue
+
+        hips_dir = os.path.normpath(os.path.join(root, url))
+        if not os.path.exists(os.path.join(hips_dir, "properties")):
+            raise FileNotFoundError(f"No HiPS properties for {url} in {hips_dir}")
+
+        properties = read_properties(hips_dir)
+        extensions = tile_extensions(properties)
+        tiles = collect_tiles(views, properties, fallback_orders=fallback_orders, aspect=aspect,
+                              margin=margin, viewport_width=viewport_width)
+
+        relpaths = hips_metadata_files(hips_dir)
+        for order, npix in sorted(tiles):
+            relpath = tile_relpath(hips_dir, order, npix, extensions)
+            if relpath is not None:
+                relpaths.append(relpath)
+
+        name = os.path.basename(hips_dir)
+        hashed_dir = os.path.join("hips", content_hash(hips_dir, relpaths), name)
+        for relpath in relpaths:
+            destination = os.path.join(data_dir, hashed_dir, relpath)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.copy2(os.path.join(hips_dir, relpath), destination)
+
+        # Bytes needed to display the first waypoint, a proxy for first-visit cost
+        if url in first_views:
+            first_tiles = collect_tiles(first_views[url], properties, fallback_orders=fallback_orders,
+                                        aspect=aspect, margin=margin, viewport_width=viewport_width)
+            for order, npix in first_tiles:
+                relpath = tile_relpath(hips_dir, order, npix, extensions)
+                if relpath is not None:
+                    total_first_visit += os.path.getsize(os.path.join(hips_dir, relpath))
+
+        source_bytes = directory_size(hips_dir)
+        exported_bytes = directory_size(os.path.join(data_dir, hashed_dir))
+        total_source += source_bytes
+        total_exported += exported_bytes
+        print(f"{url}: {len(relpaths)} files, {exported_bytes / 1024**2:.1f} MB "
+              f"of {source_bytes / 1024**2:.1f} MB -> {hashed_dir}")
+
+        url_map[url] = hashed_dir + ('/' if url.endswith('/') else '')
+        hashed_dirs.append(hashed_dir)
+
+    # Rewrite the waypoints to point at the hashed directories
+    def rewrite(value):
+        if isinstance(value, dict):
+            return {key: (url_map.get(item, item) if key in ('url', 'fade_layer') else rewrite(item))
+                    for key, item in value.items()}
+        if isinstance(value, list):
+            return [rewrite(item) for item in value]
+        return value
+
+    with open(os.path.join(tour_dir, os.path.basename(waypoints_file)), 'w') as f:
+        json.dump(rewrite(tour), f, indent=4)
+
+    write_cache_headers(data_dir, tour_dir, hashed_dirs)
+
+    print(f"Exported {total_exported / 1024**2:.1f} MB of {total_source / 1024**2:.1f} MB "
+          f"from {len(hashed_dirs)} layers to {deploy_dir}")
+    print(f"First waypoint needs {total_first_visit / 1024**2:.1f} MB of tiles")
+    print(f"Upload {data_dir} to the rootUrl location and put {tour_dir} next to the tour HTML")
+    return url_map
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('waypoints', help="Tour waypoint JSON file")
+    parser.add_argument('deploy_dir', help="Output directory for the bundle")
+    parser.add_argument('--root', default='.',
+                        help="Directory waypoint URLs are relative to (the local rootUrl)")
+    parser.add_argument('--fallback-orders', type=int, default=3,
+                        help="Number of lower orders to include below each needed order")
+    parser.add_argument('--margin', type=float, default=0.25,
+                        help="Fractional margin added around each view")
+    parser.add_argument('--aspect', type=float, default=16 / 9, help="Viewport aspect ratio")
+    parser.add_argument('--viewport-width', type=int, default=1920,
+                        help="Viewport width in pixels, used to pick HiPS orders")
+    args = parser.parse_args()
+
+    export_tour_bundle(args.waypoints, args.deploy_dir, root=args.root,
+                       fallback_orders=args.fallback_orders, margin=args.margin,
+                       aspect=args.aspect, viewport_width=args.viewport_width)
+
+if __name__ == "__main__":
+    main()
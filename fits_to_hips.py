@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 import os
-import sys
+import io
 import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from astropy.io import fits
 from astropy.wcs import WCS
@@ -16,6 +18,9 @@ from datetime import datetime
 # Force matplotlib to not use any Xwindows backend
 matplotlib.use('Agg')
 
+# JPEG quality used for every tile unless adaptive encoding is enabled
+BASELINE_JPEG_QUALITY = 90
+
 def create_custom_cmap():
     """Create a custom colormap that transitions from grayscale to hot."""
     # Define colors for custom colormap
@@ -42,10 +47,13 @@ def create_custom_cmap():
 
     return LinearSegmentedColormap('gray_to_hot', cmap_dict)
 
-def process_fits_to_image(fits_file, output_dir="temp_fits_processed"):
+def process_fits_to_image(fits_file, output_dir="temp_fits_processed", black_figfile=None):
     """
     Process FITS file to create a scaled and colored image with WCS information.
     Returns the processed data, WCS object, and file path.
+
+    If black_figfile is given, the same figure is also saved there with a black
+    background, so the savefig padding looks like blank sky.
     """
     # Create output directory if it doesn't exist
     if os.path.exists(output_dir):
@@ -99,6 +107,8 @@ def process_fits_to_image(fits_file, output_dir="temp_fits_processed"):
     # Save the image with WCS information as PNG
     figfile = os.path.join(output_dir, "colored_fits.png")
     plt.savefig(figfile, dpi=300, bbox_inches='tight')
+    if black_figfile is not None:
+        plt.savefig(black_figfile, dpi=300, bbox_inches='tight', facecolor='black')
     plt.close()
 
     # Save also as a FITS file (the normalized data)
@@ -183,11 +193,155 @@ def divide_image_into_tiles(img, order=3):
 
     return tiles
 
-def create_hips_structure(output_dir, max_order, img):
+def blank_rows(pil_img, start, stop, threshold=8):
+    """
+    Boolean mask of blank (black or fully transparent) pixels in rows
+    start:stop of a PIL image.  Only those rows are converted to an array.
+    """
+    ncols = pil_img.size[0]
+    rows = np.asarray(pil_img.crop((0, start, ncols, stop)))
+    if rows.ndim == 2:
+        return rows <= threshold
+    blank = rows[..., :3].max(axis=-1) <= threshold
+    if rows.shape[-1] == 4:
+        blank |= rows[..., 3] == 0
+    return blank
+
+def find_edge_connected_blank(pil_img, threshold=8, chunk_rows=1024):
+    """
+    Find blank/black regions that are connected to the edge of the image.
+
+    The image is processed in horizontal chunks of ``chunk_rows`` rows, so
+    only one chunk of pixels and labels is held in memory at a time.  A first
+    pass labels each chunk with scipy.ndimage.label and records which labels
+    touch across chunk boundaries or touch the image edge; labels are then
+    merged so a region spanning several chunks is treated as one.  A second
+    pass relabels each chunk and yields ``(start_row, mask)`` pairs, where mask
+    is True where pixels should become transparent.  Black regions that do not
+    touch the edge (e.g. saturated star cores) are left opaque.
+    """
+    from scipy import ndimage
+
+    ncols, nrows = pil_img.size
+    chunk_starts = list(range(0, nrows, chunk_rows))
+
+    def label_chunk(start):
+        stop = min(start + chunk_rows, nrows)
+        return ndimage.label(blank_rows(pil_img, start, stop, threshold=threshold))
+
+    # First pass: count labels, and record boundary-row and edge labels
+    offsets = []
+    nlabels = 0
+    pairs = []
+    edge_labels = []
+    previous_last_row = None
+    for start in chunk_starts:
+        chunk_labels, nchunk = label_chunk(start)
+        chunk_labels = np.where(chunk_labels > 0, chunk_labels + nlabels, 0)
+        offsets.append(nlabels)
+        nlabels += nchunk
+
+        edge_labels.extend([chunk_labels[:, 0], chunk_labels[:, -1]])
+        if start == 0:
+            edge_labels.append(chunk_labels[0])
+        if start == chunk_starts[-1]:
+            edge_labels.append(chunk_labels[-1])
+
+        # Labels that touch across the boundary with the previous chunk
+        if previous_last_row is not None:
+            below = chunk_labels[0]
+            touching = (previous_last_row > 0) & (below > 0)
+            pairs.append(np.stack([previous_last_row[touching], below[touching]], axis=1))
+        previous_last_row = chunk_labels[-1]
+
+    # Merge labels across chunk boundaries: every label points at the
+    # smallest label it is connected to
+    parent = np.arange(nlabels + 1, dtype=np.int32)
+    if pairs:
+        pairs = np.concatenate(pairs)
+        left, right = pairs[:, 0], pairs[:, 1]
+        while True:
+            root_left = parent[left]
+            root_right = parent[right]
+            if np.all(root_left == root_right):
+                break
+            low = np.minimum(root_left, root_right)
+            np.minimum.at(parent, root_left, low)
+            np.minimum.at(parent, root_right, low)
+            # Path compression until every label points at its root
+            while True:
+                compressed = parent[parent]
+                if np.array_equal(compressed, parent):
+                    break
+                parent = compressed
+
+    # Components touching any image edge become transparent
+    is_edge = np.zeros(nlabels + 1, dtype=bool)
+    is_edge[parent[np.concatenate(edge_labels)]] = True
+    is_edge[0] = False
+    is_transparent = is_edge[parent]
+
+    # Second pass: relabel each chunk and look up which pixels are transparent
+    for start, offset in zip(chunk_starts, offsets):
+        chunk_labels, _ = label_chunk(start)
+        yield start, is_transparent[np.where(chunk_labels > 0, chunk_labels + offset, 0)]
+
+def create_transparency_mask(pil_img, threshold=8, chunk_rows=1024):
+    """
+    Create an alpha mask ('L' mode image) for a PIL image, with edge-connected
+    blank regions set to 0 and everything else set to 255.
+    """
+    alpha = Image.new('L', pil_img.size, 255)
+    for start, mask in find_edge_connected_blank(pil_img, threshold=threshold,
+                                                 chunk_rows=chunk_rows):
+        alpha.paste(Image.fromarray(np.where(mask, 0, 255).astype(np.uint8), mode='L'),
+                    (0, start))
+    return alpha
+
+def transparent_hips_dir(output_dir):
+    """
+    Name of the transparent HiPS directory that goes with output_dir,
+    following the <name>_transparent_hips convention.
+    """
+    output_dir = output_dir.rstrip(os.sep)
+    if output_dir.endswith("_hips"):
+        return output_dir[:-len("_hips")] + "_transparent_hips"
+    return output_dir + "_transparent"
+
+def create_hips_structure(output_dir, max_order, img, transparent_dir=None, mask_source=None,
+                          threshold=8, chunk_rows=1024, target_bytes=None, target_psnr=None,
+                          workers=None):
     """
     Create the HiPS directory structure with tiles up to max_order.
+
+    If transparent_dir is given, a second HiPS with PNG tiles is written there
+    in the same pass, with edge-connected black regions made transparent.
+    The blank regions are found in mask_source (default: img), which should be
+    the same render as img but with a black background instead of the white
+    savefig padding.
+
+    If target_bytes or target_psnr is given, each JPEG tile is encoded at the
+    quality that meets that target (see adaptive_encode_tile()) using
+    `workers` processes, and the savings are reported per order.
     """
     print(f"Creating HiPS structure with orders 0 to {max_order}...")
+    savings_by_order = {}
+
+    alpha_img = None
+    if transparent_dir is not None:
+        print("Finding edge-connected blank regions for transparent tiles...")
+        alpha_img = create_transparency_mask(Image.open(mask_source or img), threshold=threshold,
+                                             chunk_rows=chunk_rows)
+        img_size = Image.open(img).size
+        if alpha_img.size != img_size:
+            alpha_img = alpha_img.resize(img_size, Image.NEAREST)
+
+        # Allsky for the transparent HiPS
+        allsky_rgba = Image.open(img).convert('RGB')
+        allsky_rgba.putalpha(alpha_img)
+        os.makedirs(os.path.join(transparent_dir, "Norder0"), exist_ok=True)
+        allsky_rgba.save(os.path.join(transparent_dir, "Allsky.png"))
+        allsky_rgba.save(os.path.join(transparent_dir, "Norder0", "Allsky.png"))
 
     # For each order
     for order in range(max_order + 1):
@@ -201,6 +355,9 @@ def create_hips_structure(output_dir, max_order, img):
             dir_idx = ipix // 10000
             dir_path = os.path.join(output_dir, f"Norder{order}", f"Dir{dir_idx}")
             os.makedirs(dir_path, exist_ok=True)
+            if transparent_dir is not None:
+                os.makedirs(os.path.join(transparent_dir, f"Norder{order}", f"Dir{dir_idx}"),
+                            exist_ok=True)
 
         # For order 0, we just have Allsky.jpg and 12 base pixels
         if order == 0:
@@ -213,9 +370,12 @@ def create_hips_structure(output_dir, max_order, img):
             pil_img = Image.open(img)
             tiles = divide_image_into_tiles(pil_img, order=0)
 
-            for ipix, tile in tiles.items():
-                tile_path = os.path.join(output_dir, f"Norder{order}", f"Dir0", f"Npix{ipix}.jpg")
-                tile.save(tile_path, quality=90)
+            savings = save_jpeg_tiles(output_dir, order, tiles, target_bytes=target_bytes,
+                                      target_psnr=target_psnr, workers=workers)
+
+            if alpha_img is not None:
+                alpha_tiles = divide_image_into_tiles(alpha_img, order=0)
+                save_transparent_tiles(transparent_dir, order, tiles, alpha_tiles)
         else:
             # For higher orders, generate tiles by dividing the source image
             pil_img = Image.open(img)
@@ -226,20 +386,172 @@ def create_hips_structure(output_dir, max_order, img):
 
             tiles = divide_image_into_tiles(resized_img, order=order)
 
-            for ipix, tile in tiles.items():
-                dir_idx = ipix // 10000
-                tile_path = os.path.join(output_dir, f"Norder{order}", f"Dir{dir_idx}", f"Npix{ipix}.jpg")
-                tile.save(tile_path, quality=90)
+            savings = save_jpeg_tiles(output_dir, order, tiles, target_bytes=target_bytes,
+                                      target_psnr=target_psnr, workers=workers)
+
+            if alpha_img is not None:
+                # Tile the alpha mask exactly like the image so tiles line up
+                resized_alpha = alpha_img.resize(resized_img.size, Image.LANCZOS)
+                alpha_tiles = divide_image_into_tiles(resized_alpha, order=order)
+                save_transparent_tiles(transparent_dir, order, tiles, alpha_tiles)
+
+        if savings is not None:
+            savings_by_order[order] = savings
+
+    if savings_by_order:
+        report_encoding_savings(savings_by_order)
 
     print(f"Created HiPS structure with orders 0 to {max_order}")
 
-def create_basic_hips_structure(output_dir, fits_file, title, coordsys="galactic", max_order=3):
+def encode_jpeg(tile, quality):
+    """
+    Encode a tile as JPEG in memory and return the bytes.  Uses the same
+    settings as the fixed-quality tile.save(), so sizes are comparable with
+    the baseline and differ only by the chosen quality.
+    """
+    buffer = io.BytesIO()
+    tile.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+def jpeg_psnr(reference, data):
+    """PSNR (dB) of encoded JPEG data against the reference tile array"""
+    decoded = np.asarray(Image.open(io.BytesIO(data)), dtype=np.float64)
+    mse = np.mean((decoded - reference) ** 2)
+    if mse == 0:
+        return np.inf
+    return 10 * np.log10(255 ** 2 / mse)
+
+def adaptive_encode_tile(tile, target_bytes=None, target_psnr=None, min_quality=20, max_quality=95):
+    """
+    Binary search for the JPEG quality that meets a per-tile target.
+
+    With target_psnr, returns the lowest quality whose PSNR is at least
+    target_psnr (max_quality if none is).  With target_bytes, returns the
+    highest quality that fits in target_bytes (min_quality if none does).
+    Returns (quality, data).
+    """
+    if target_psnr is not None:
+        reference = np.asarray(tile.convert('RGB'), dtype=np.float64)
+
+        def meets(data):
+            return jpeg_psnr(reference, data) >= target_psnr
+
+        low, high = min_quality, max_quality
+        best = (max_quality, encode_jpeg(tile, max_quality))
+        while low <= high:
+            quality = (low + high) // 2
+            data = encode_jpeg(tile, quality)
+            if meets(data):
+                best = (quality, data)
+                high = quality - 1
+            else:
+                low = quality + 1
+        return best
+
+    low, high = min_quality, max_quality
+    best = (min_quality, encode_jpeg(tile, min_quality))
+    while low <= high:
+        quality = (low + high) // 2
+        data = encode_jpeg(tile, quality)
+        if len(data) <= target_bytes:
+            best = (quality, data)
+            low = quality + 1
+        else:
+            high = quality - 1
+    return best
+
+def encode_tile_job(job):
+    """
+    Worker for save_jpeg_tiles(): adaptively encode and write one tile.
+    Returns (baseline_bytes, encoded_bytes, quality).
+    """
+    tile_path, tile, target_bytes, target_psnr = job
+    baseline_bytes = len(encode_jpeg(tile, BASELINE_JPEG_QUALITY))
+    quality, data = adaptive_encode_tile(tile, target_bytes=target_bytes, target_psnr=target_psnr)
+    with open(tile_path, 'wb') as f:
+        f.write(data)
+    return baseline_bytes, len(data), quality
+
+def save_jpeg_tiles(output_dir, order, tiles, target_bytes=None, target_psnr=None, workers=None):
+    """
+    Save the JPEG tiles for one order.
+
+    Without a target every tile is saved at BASELINE_JPEG_QUALITY and None is
+    returned.  With target_bytes or target_psnr, tiles are encoded adaptively
+    in a pool of worker processes and the per-tile
+    (baseline_bytes, encoded_bytes, quality) results are returned.
+    """
+    def tile_path(ipix):
+        return os.path.join(output_dir, f"Norder{order}", f"Dir{ipix // 10000}", f"Npix{ipix}.jpg")
+
+    if target_bytes is None and target_psnr is None:
+        for ipix, tile in tiles.items():
+            tile.save(tile_path(ipix), quality=BASELINE_JPEG_QUALITY)
+        return None
+
+    jobs = [(tile_path(ipix), tile, target_bytes, target_psnr) for ipix, tile in tiles.items()]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(encode_tile_job, jobs, chunksize=8))
+
+def report_encoding_savings(savings_by_order):
+    """
+    Print the distribution of bytes saved per tile against the fixed-quality
+    baseline, for each order.
+    """
+    print(f"Adaptive encoding vs. quality={BASELINE_JPEG_QUALITY} baseline:")
+    total_baseline = 0
+    total_encoded = 0
+    for order, savings in sorted(savings_by_order.items()):
+        baseline, encoded, quality = np.array(savings).T
+        saved = baseline - encoded
+        total_baseline += baseline.sum()
+        total_encoded += encoded.sum()
+        p10, p50, p90 = np.percentile(saved, [10, 50, 90])
+        print(f"  Norder{order}: {len(saved)} tiles, {baseline.sum() / 1024**2:.2f} MB -> "
+              f"{encoded.sum() / 1024**2:.2f} MB ({100 * saved.sum() / baseline.sum():.1f}% saved); "
+              f"bytes saved per tile p10/p50/p90 = {p10:.0f}/{p50:.0f}/{p90:.0f}; "
+              f"median quality {np.median(quality):.0f}")
+    print(f"  Total: {total_baseline / 1024**2:.2f} MB -> {total_encoded / 1024**2:.2f} MB")
+
+def save_transparent_tiles(transparent_dir, order, tiles, alpha_tiles):
+    """
+    Combine image tiles with their alpha tiles and save them as PNG.
+    """
+    for ipix, tile in tiles.items():
+        dir_idx = ipix // 10000
+        rgba = tile.convert('RGB')
+        rgba.putalpha(alpha_tiles[ipix])
+        tile_path = os.path.join(transparent_dir, f"Norder{order}", f"Dir{dir_idx}", f"Npix{ipix}.png")
+        rgba.save(tile_path)
+
+def render_allsky(png_file, output_path, format='jpg', facecolor='white'):
+    """
+    Re-render the processed PNG as the Allsky image.
+    """
+    plt.figure(figsize=(10, 10), dpi=300)
+    img = plt.imread(png_file)
+    plt.imshow(img)
+    plt.axis('off')
+    plt.savefig(output_path, format=format, dpi=300, bbox_inches='tight', facecolor=facecolor)
+    plt.close()
+
+def create_basic_hips_structure(output_dir, fits_file, title, coordsys="galactic", max_order=3,
+                                transparent=False, target_bytes=None, target_psnr=None,
+                                workers=None):
     """
     Create a basic HiPS directory structure with the minimum necessary files.
     Now supports higher order tiles.
+
+    If transparent is True, a <name>_transparent_hips variant with PNG tiles
+    is built alongside in the same run.  target_bytes, target_psnr and workers
+    are passed to create_hips_structure() for adaptive tile encoding.
     """
-    # Process the FITS file
-    data, wcs, png_file, fits_file = process_fits_to_image(fits_file)
+    # Process the FITS file.  For the transparent variant, also render it on a
+    # black background so the savefig padding is blank and edge-connected
+    black_png_file = None
+    if transparent:
+        black_png_file = os.path.join("temp_fits_processed", "colored_fits_black.png")
+    data, wcs, png_file, fits_file = process_fits_to_image(fits_file, black_figfile=black_png_file)
 
     # Create output directory if it doesn't exist
     if not os.path.exists(output_dir):
@@ -252,13 +564,14 @@ def create_basic_hips_structure(output_dir, fits_file, title, coordsys="galactic
     os.makedirs(os.path.join(output_dir, "Norder0", "Dir0"), exist_ok=True)
 
     # Convert PNG to JPG for Allsky
-    plt.figure(figsize=(10, 10), dpi=300)
-    img = plt.imread(png_file)
-    plt.imshow(img)
-    plt.axis('off')
     allsky_path = os.path.join(output_dir, "Allsky.jpg")
-    plt.savefig(allsky_path, format='jpg', dpi=300, bbox_inches='tight')
-    plt.close()
+    render_allsky(png_file, allsky_path, format='jpg')
+
+    # Matching lossless black-background Allsky to find blank regions in
+    mask_source = None
+    if transparent:
+        mask_source = os.path.join("temp_fits_processed", "allsky_black.png")
+        render_allsky(black_png_file, mask_source, format='png', facecolor='black')
 
     # Make sure the Allsky.jpg file exists
     if not os.path.exists(allsky_path):
@@ -276,7 +589,9 @@ def create_basic_hips_structure(output_dir, fits_file, title, coordsys="galactic
         print(f"Created tile Norder0/Dir0/Npix{npix}.jpg")
 
     # Create the HiPS structure with tiles
-    create_hips_structure(output_dir, max_order, allsky_path)
+    transparent_dir = transparent_hips_dir(output_dir) if transparent else None
+    create_hips_structure(output_dir, max_order, allsky_path, transparent_dir=transparent_dir,
+                          mask_source=mask_source, target_bytes=target_bytes, target_psnr=target_psnr, workers=workers)
 
     # Create a properties file for the HiPS dataset
     properties = f"""creator_did=urn:ACES:{title.replace(' ', '_')}
@@ -296,6 +611,15 @@ client_sort_key=04-03-01
     with open(os.path.join(output_dir, "properties"), 'w') as f:
         f.write(properties)
 
+    if transparent_dir is not None:
+        transparent_properties = properties.replace(
+            f"creator_did=urn:ACES:{title.replace(' ', '_')}",
+            f"creator_did=urn:ACES:{title.replace(' ', '_')}_transparent",
+        ).replace("hips_tile_format=jpg", "hips_tile_format=png")
+        with open(os.path.join(transparent_dir, "properties"), 'w') as f:
+            f.write(transparent_properties)
+        print(f"Transparent HiPS structure created in: {transparent_dir}")
+
     print(f"HiPS structure created in: {output_dir}")
     return output_dir
 
@@ -512,26 +836,46 @@ var ShowMore = function () {{ "use strict"; var e = function (e, t) {{ var n = e
     print(f"index.html created in {hips_dir}")
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python fits_to_hips.py <fits_file> [output_directory] [title] [max_order]")
-        sys.exit(1)
-
-    fits_file = sys.argv[1]
-    output_dir = sys.argv[2] if len(sys.argv) > 2 else "hips_output"
-    title = sys.argv[3] if len(sys.argv) > 3 else "ACES Continuum"
-    max_order = int(sys.argv[4]) if len(sys.argv) > 4 else 3  # Default to order 3
+    parser = argparse.ArgumentParser(description="Convert a FITS image to a HiPS directory")
+    parser.add_argument('fits_file')
+    parser.add_argument('output_dir', nargs='?', default="hips_output")
+    parser.add_argument('title', nargs='?', default="ACES Continuum")
+    parser.add_argument('max_order', nargs='?', type=int, default=3)  # Default to order 3
+    parser.add_argument('--transparent', action='store_true',
+                        help="Also build a <name>_transparent_hips variant with PNG tiles")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--target-bytes', type=int,
+                        help="Adaptive encoding: best JPEG quality that fits in this many bytes per tile")
+    target.add_argument('--target-psnr', type=float,
+                        help="Adaptive encoding: smallest JPEG tile with at least this PSNR (dB)")
+    parser.add_argument('--workers', type=int, help="Worker processes for adaptive encoding")
+    args = parser.parse_args()
+
+    fits_file = args.fits_file
+    output_dir = args.output_dir
+    title = args.title
+    max_order = args.max_order
+    transparent = args.transparent
 
     print(f"Processing {fits_file}...")
     print(f"Output directory: {output_dir}")
     print(f"Maximum HiPS order: {max_order}")
 
     # Create HiPS from FITS
-    hips_dir = create_basic_hips_structure(output_dir, fits_file, title, max_order=max_order)
+    hips_dir = create_basic_hips_structure(output_dir, fits_file, title, max_order=max_order,
+                                           transparent=transparent, target_bytes=args.target_bytes,
+                                           target_psnr=args.target_psnr, workers=args.workers)
 
     # Create HpxFinder and index.html
     create_hpxfinder_structure(hips_dir, title, max_order)
     create_index_html(hips_dir, title)
 
+    if transparent:
+        transparent_dir = transparent_hips_dir(hips_dir)
+        create_hpxfinder_structure(transparent_dir, f"{title} transparent", max_order)
+        create_index_html(transparent_dir, f"{title} transparent")
+        print(f"Transparent HiPS files are in: {transparent_dir}")
+
     print(f"HiPS generation complete. Files are in: {hips_dir}")
     print("You can now use this HiPS directory in your Aladin Lite tour.")
 
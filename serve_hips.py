@@ -3,17 +3,194 @@
 Simple HTTP server to serve the HiPS files and Aladin Lite tour
 """
 import os
+import re
+import io
 import sys
+import json
+import time
+import signal
+import argparse
+import email.utils
+import datetime
 import http.server
 import socketserver
 import webbrowser
-from urllib.parse import urlparse
+from collections import OrderedDict, Counter, defaultdict
+from urllib.parse import urlparse, unquote
 
 PORT = 8000
 DIRECTORY = os.getcwd()
 
+# Matches HiPS tile and Allsky requests, e.g. /foo_hips/Norder3/Dir0/Npix270.jpg
+TILE_RE = re.compile(r'/Norder(?P<order>\d+)/(?:Dir\d+/Npix(?P<npix>\d+)|Allsky)\.\w+$')
+
+# Upper edges (ms) of the latency histogram bins; the last bin is open-ended
+LATENCY_BINS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500]
+
+
+class AccessLog:
+    """Buffered JSON-lines access log, one record per request"""
+
+    def __init__(self, filename, buffer_size=1 << 16, flush_interval=2.0):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self._file = open(filename, 'a', buffering=buffer_size)
+        self._last_flush = time.monotonic()
+
+    def write(self, record):
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def flush_if_due(self):
+        """Flush if flush_interval has passed; called from the server's poll loop"""
+        now = time.monotonic()
+        if now - self._last_flush > self.flush_interval:
+            self._file.flush()
+            self._last_flush = now
+
+    def close(self):
+        self._file.close()
+
+
+class TileCache:
+    """
+    In-memory LRU cache of tile file contents, keyed by URL path.
+    Each entry stores the file's mtime so stale entries can be detected.
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._data = OrderedDict()
+
+    def get(self, path, mtime):
+        """Cached data for path, or None if missing or older than mtime"""
+        entry = self._data.get(path)
+        if entry is None or entry[1] != mtime:
+            return None
+        self._data.move_to_end(path)
+        return entry[0]
+
+    def put(self, path, data, mtime):
+        if len(data) > self.max_bytes:
+            return
+        if path in self._data:
+            self.nbytes -= len(self._data.pop(path)[0])
+        self._data[path] = (data, mtime)
+        self.nbytes += len(data)
+        while self.nbytes > self.max_bytes:
+            _, (evicted, _) = self._data.popitem(last=False)
+            self.nbytes -= len(evicted)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, path):
+        return path in self._data
+
+
 class CORSHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
     """Handler with CORS support"""
+
+    # Set by start_server(); None disables the feature
+    access_log = None
+    tile_cache = None
+
+    def handle_one_request(self):
+        self._request_start = None
+        self._status = None
+        self._nbytes = 0
+        self._cache_hit = False
+        super().handle_one_request()
+        if self.access_log is not None and self._request_start is not None:
+            self.write_access_record()
+
+    def parse_request(self):
+        self._request_start = time.perf_counter()
+        return super().parse_request()
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'content-length':
+            self._nbytes = int(value)
+        super().send_header(keyword, value)
+
+    def send_head(self):
+        # Serve tiles from the in-memory cache when enabled
+        if self.tile_cache is None or self.command != 'GET':
+            return super().send_head()
+
+        path = unquote(urlparse(self.path).path)
+        if not TILE_RE.search(path):
+            return super().send_head()
+
+        filename = self.translate_path(self.path)
+        if not os.path.isfile(filename):
+            return super().send_head()
+
+        # Revalidate against the file on disk so regenerated tiles are picked up
+        mtime = os.stat(filename).st_mtime
+        data = self.tile_cache.get(path, mtime)
+        if data is None:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            self.tile_cache.put(path, data, mtime)
+        else:
+            self._cache_hit = True
+
+        if self.not_modified_since(mtime):
+            self.send_response(304)
+            self.end_headers()
+            return None
+
+        self.send_response(200)
+        self.send_header('Content-type', self.guess_type(path))
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Last-Modified', self.date_time_string(mtime))
+        self.end_headers()
+        return io.BytesIO(data)
+
+    def not_modified_since(self, mtime):
+        """
+        True if the request's If-Modified-Since covers mtime, following the
+        same rules as SimpleHTTPRequestHandler.send_head()
+        """
+        if 'If-Modified-Since' not in self.headers or 'If-None-Match' in self.headers:
+            return False
+        try:
+            ims = email.utils.parsedate_to_datetime(self.headers['If-Modified-Since'])
+        except (TypeError, IndexError, OverflowError, ValueError):
+            return False
+        if ims.tzinfo is None:
+            ims = ims.replace(tzinfo=datetime.timezone.utc)
+        if ims.tzinfo is not datetime.timezone.utc:
+            return False
+        last_modif = datetime.datetime.fromtimestamp(mtime, datetime.timezone.utc)
+        return last_modif.replace(microsecond=0) <= ims
+
+    def write_access_record(self):
+        """Append a structured record for the current request to the access log"""
+        path = unquote(urlparse(self.path).path)
+        record = {
+            'time': time.time(),
+            'method': self.command,
+            'path': path,
+            'status': self._status,
+            # HEAD responses carry a Content-Length but no body
+            'bytes': self._nbytes if self.command == 'GET' else 0,
+            'latency_ms': round((time.perf_counter() - self._request_start) * 1000, 3),
+            'cache_hit': self._cache_hit,
+        }
+        match = TILE_RE.search(path)
+        if match:
+            record['order'] = int(match.group('order'))
+            if match.group('npix') is not None:
+                record['npix'] = int(match.group('npix'))
+        self.access_log.write(record)
+
+    def log_request(self, code='-', size='-'):
+        self._status = code.value if hasattr(code, 'value') else code
+        # The structured access log replaces the per-request stderr lines
+        if self.access_log is None:
+            super().log_request(code, size)
     
     def end_headers(self):
         # Add CORS headers
@@ -36,26 +213,157 @@ class CORSHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 sys.stderr.write(f"Serving: {filepath}\n")
         return super().log_message(format, *args)
 
-def start_server(port=PORT, directory=DIRECTORY):
+def load_hot_tiles(filename):
+    """
+    Load a hot-tile file written by analyze_access_log().
+    Accepts either {"tiles": [{"path": ...}, ...]} or a plain list of paths.
+    """
+    with open(filename) as f:
+        hot = json.load(f)
+    if isinstance(hot, dict):
+        hot = hot['tiles']
+    return [entry['path'] if isinstance(entry, dict) else entry for entry in hot]
+
+def prewarm_cache(cache, hot_tiles, directory=DIRECTORY):
+    """Read the hot tiles from disk into the cache, hottest first"""
+    nloaded = 0
+    for path in hot_tiles:
+        filename = os.path.join(directory, path.lstrip('/'))
+        if not os.path.isfile(filename):
+            continue
+        # Stop rather than evict hotter tiles that are already loaded
+        if cache.nbytes + os.path.getsize(filename) > cache.max_bytes:
+            break
+        with open(filename, 'rb') as f:
+            cache.put(path, f.read(), os.stat(filename).st_mtime)
+        nloaded += 1
+    print(f"Pre-warmed cache with {nloaded} of {len(hot_tiles)} hot tiles "
+          f"({cache.nbytes / 1024**2:.1f} MB)")
+    return nloaded
+
+def latency_bin_label(index):
+    """Human-readable label for a LATENCY_BINS_MS histogram bin"""
+    if index == len(LATENCY_BINS_MS):
+        return f">{LATENCY_BINS_MS[-1]}ms"
+    low = LATENCY_BINS_MS[index - 1] if index > 0 else 0
+    return f"{low}-{LATENCY_BINS_MS[index]}ms"
+
+def analyze_access_log(log_filename, hot_tiles_filename=None, top=50):
+    """
+    Aggregate a JSON-lines access log into hot-tile rankings and per-order
+    latency histograms.  If hot_tiles_filename is given, the ranking is written
+    there in the format accepted by --prewarm.
+    """
+    hits = Counter()
+    tile_bytes = {}
+    latencies = defaultdict(list)
+
+    with open(log_filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if ('order' not in record or record.get('method') != 'GET'
+                    or record.get('status') != 200):
+                continue
+            hits[record['path']] += 1
+            tile_bytes[record['path']] = record['bytes']
+            latencies[record['order']].append(record['latency_ms'])
+
+    print(f"Top {min(top, len(hits))} of {len(hits)} requested tiles:")
+    ranking = hits.most_common(top)
+    for path, count in ranking:
+        print(f"  {count:8d}  {path}")
+
+    print("Latency histogram per order:")
+    for order in sorted(latencies):
+        values = latencies[order]
+        counts = [0] * (len(LATENCY_BINS_MS) + 1)
+        for value in values:
+            index = next((i for i, edge in enumerate(LATENCY_BINS_MS) if value <= edge),
+                         len(LATENCY_BINS_MS))
+            counts[index] += 1
+        print(f"  Norder{order}: {len(values)} requests, "
+              f"mean {sum(values) / len(values):.2f}ms, max {max(values):.2f}ms")
+        for index, count in enumerate(counts):
+            if count:
+                print(f"    {latency_bin_label(index):>10s}  {count}")
+
+    if hot_tiles_filename is not None:
+        hot = {'tiles': [{'path': path, 'hits': count, 'bytes': tile_bytes[path]}
+                         for path, count in ranking]}
+        with open(hot_tiles_filename, 'w') as f:
+            json.dump(hot, f, indent=1)
+        print(f"Wrote {len(ranking)} hot tiles to {hot_tiles_filename}")
+
+    return ranking
+
+class HiPSServer(socketserver.TCPServer):
+    """TCP server that flushes the access log from its poll loop"""
+
+    def service_actions(self):
+        # Runs every poll_interval even when idle, so buffered records are
+        # written out without waiting for the next request
+        if self.RequestHandlerClass.access_log is not None:
+            self.RequestHandlerClass.access_log.flush_if_due()
+
+def stop_on_sigterm(signum, frame):
+    """Turn SIGTERM into the same clean shutdown as Ctrl-C"""
+    raise KeyboardInterrupt
+
+def start_server(port=PORT, directory=DIRECTORY, access_log=None, prewarm=None,
+                 cache_mb=512, open_browser=True):
     """Start the HTTP server"""
     handler = CORSHTTPRequestHandler
+
+    if access_log is not None:
+        handler.access_log = AccessLog(access_log)
+        print(f"Writing access log to {access_log}")
+
+    if prewarm is not None:
+        handler.tile_cache = TileCache(max_bytes=cache_mb * 1024 * 1024)
+        prewarm_cache(handler.tile_cache, load_hot_tiles(prewarm), directory=directory)
     
-    with socketserver.TCPServer(("", port), handler) as httpd:
+    signal.signal(signal.SIGTERM, stop_on_sigterm)
+
+    with HiPSServer(("", port), handler) as httpd:
         print(f"Serving at http://localhost:{port}")
         print(f"Aladin Lite tour: http://localhost:{port}/aladin_lite_tour.html")
         
         # Open the browser with the tour
-        webbrowser.open(f"http://localhost:{port}/aladin_lite_tour.html")
+        if open_browser:
+            webbrowser.open(f"http://localhost:{port}/aladin_lite_tour.html")
         
         try:
-            httpd.serve_forever()
+            httpd.serve_forever(poll_interval=0.5)
         except KeyboardInterrupt:
             print("\nServer stopped.")
             httpd.server_close()
+        finally:
+            if handler.access_log is not None:
+                handler.access_log.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--access-log', help="Write a JSON-lines access log to this file")
+    parser.add_argument('--prewarm', help="Hot-tile JSON file used to pre-warm the tile cache")
+    parser.add_argument('--cache-mb', type=int, default=512, help="Tile cache size in MB")
+    parser.add_argument('--no-browser', action='store_true', help="Don't open a browser")
+    parser.add_argument('--analyze', metavar='ACCESS_LOG',
+                        help="Summarize an access log instead of serving")
+    parser.add_argument('--hot-tiles', help="With --analyze, write the hot-tile ranking here")
+    parser.add_argument('--top', type=int, default=50, help="Number of hot tiles to keep")
+    args = parser.parse_args()
+
+    if args.analyze:
+        analyze_access_log(args.analyze, args.hot_tiles, top=args.top)
+        sys.exit(0)
+
     # Set the directory to serve
     os.chdir(DIRECTORY)
     
     # Start the server
-    start_server() 
\ No newline at end of file
+    start_server(port=args.port, access_log=args.access_log, prewarm=args.prewarm,
+                 cache_mb=args.cache_mb, open_browser=not args.no_browser)
\ No newline at end of file